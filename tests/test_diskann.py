@@ -1,35 +1,72 @@
+import functools
+import hashlib
+import json
 import mysql.connector
+import numpy as np
+import os
+import re
+import shutil
 import sys
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+from mysql.connector.pooling import MySQLConnectionPool
 
-def get_connection():
+try:
+    # orjson parses bytes directly and is several times faster on small payloads
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Hint that routes a statement to DuckDB; it has to be sent with every statement
+DUCK_HINT = "/*+ duck_execute */ "
+
+# Matches labels in the serialized form of a faiss_search result: "{'rank': 0, 'label': 5721, ...}"
+LABEL_RE = re.compile(rb"'label':\s*(\d+)")
+
+# Recall queries and their ground truth are persisted here between runs
+GT_CACHE_DIR = "/tmp/test_diskann_cache"
+
+def _connect(connect):
+    # Calls connect(**config), retrying with the fallback password if the empty one is rejected
     config = {
         'user': 'root',
         'password': '',
         'host': '127.0.0.1',
         'port': 7123,
-        'database': 'test'
+        'database': 'test',
+        # Commit once per phase instead of after every statement
+        'autocommit': False
     }
     try:
-        conn = mysql.connector.connect(**config)
-        return conn
+        return connect(**config)
     except mysql.connector.Error as err:
         print(f"Failed with empty password: {err}")
         # Try with password '123456'
         config['password'] = '123456'
         try:
-            conn = mysql.connector.connect(**config)
-            return conn
+            return connect(**config)
         except mysql.connector.Error as err2:
             print(f"Failed with password '123456': {err2}")
             raise
 
-def execute_duck(cursor, sql, verbose=True):
-    duck_sql = f"/*+ duck_execute */ {sql}"
+def get_connection():
+    return _connect(mysql.connector.connect)
+
+def get_connection_pool(size):
+    # Connections are checked out once per worker, so skip the session reset on every return
+    return _connect(functools.partial(MySQLConnectionPool, pool_name="test_diskann", pool_size=size, pool_reset_session=False))
+
+def execute_duck(cursor, sql, verbose=True, expected_rows=None):
+    duck_sql = DUCK_HINT + sql
     if verbose:
         print(f"Executing: {duck_sql}")
     try:
         cursor.execute(duck_sql)
+        # Callers that know the result size (e.g. search with k) skip the with_rows check
+        if expected_rows is not None:
+            return cursor.fetchmany(expected_rows)
         # Fetch results if any
         if cursor.with_rows:
             return cursor.fetchall()
@@ -39,13 +76,58 @@ def execute_duck(cursor, sql, verbose=True):
             print(f"Error executing SQL: {err}")
     return None
 
+def cleanup(conn, cursor):
+    print("\n--- Cleanup ---")
+    execute_duck(cursor, "CALL faiss_destroy('test_index')")
+    execute_duck(cursor, "drop table ltmdb_sql.vectordb.list")
+    execute_duck(cursor, "drop schema ltmdb_sql.vectordb")
+    conn.commit()
+
+def parse_results(row):
+    # Returns the faiss_search results held in one row as a list of dicts
+    value = row[0] if len(row) == 1 else row
+    if isinstance(value, dict):
+        return [value]
+    if isinstance(value, list) and all(isinstance(v, dict) for v in value):
+        return value
+    # Raw cursors hand back bytearrays, which are parsed as-is without decoding
+    if isinstance(value, str):
+        value = value.encode()
+    elif not isinstance(value, (bytes, bytearray)):
+        value = str(row).encode()
+    # DuckDB serializes STRUCTs with single-quoted keys; with numeric fields, swapping quotes gives JSON
+    try:
+        doc = json_loads(value.replace(b"'", b'"'))
+    except ValueError:
+        return [{'label': int(label)} for label in LABEL_RE.findall(value)]
+    if isinstance(doc, dict):
+        return [doc]
+    return [d for d in doc if isinstance(d, dict)] if isinstance(doc, list) else []
+
+def extract_labels(row):
+    return [doc['label'] for doc in parse_results(row) if 'label' in doc]
+
+def row_matches(row, label, max_dist=None):
+    # The distance is only checked when max_dist is given
+    for doc in parse_results(row):
+        if doc.get('label') == label and (max_dist is None or doc.get('distance', 1) < max_dist):
+            return True
+    return False
+
 def main():
+    # Fixed seed so the generated data, and therefore the recall numbers, are reproducible
+    rng = np.random.default_rng(42)
+    # The recall query set is fixed up front, so its ground truth can be reused across runs
+    num_queries = 100
+    k = 10
+    queries = rng.random((num_queries, 5), dtype=np.float32)
+    np.round(queries, 2, out=queries)
     conn = None
     try:
         conn = get_connection()
         if conn.is_connected():
             print("Connected to MySQL server")
-            cursor = conn.cursor()
+            cursor = conn.cursor(buffered=True)
 
             # 1. Cleanup
             print("\n--- Cleaning up ---")
@@ -53,18 +135,19 @@ def main():
             execute_duck(cursor, "drop schema if exists ltmdb_sql.vectordb")
             
             # Cleanup filesystem
-            import shutil
-            import os
-            import glob
             print("Cleaning up /tmp/test_diskann_save* ...")
-            for f in glob.glob("/tmp/test_diskann_save*"):
-                try:
-                    if os.path.isdir(f):
-                        shutil.rmtree(f)
-                    else:
-                        os.remove(f)
-                except Exception as e:
-                    print(f"Error removing {f}: {e}")
+            # scandir gets the entry type from readdir, so there is no extra stat per entry
+            with os.scandir("/tmp") as entries:
+                for entry in entries:
+                    if not entry.name.startswith("test_diskann_save"):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            shutil.rmtree(entry.path)
+                        else:
+                            os.remove(entry.path)
+                    except Exception as e:
+                        print(f"Error removing {entry.path}: {e}")
 
             # 2. Setup Schema and Table
             print("\n--- Setting up Schema and Table ---")
@@ -76,32 +159,53 @@ def main():
             # Generate 20000 points. With 5 dimensions, this is small, but if we set budget small enough it should trigger.
             # 5 dims * 4 bytes = 20 bytes raw. Plus overhead.
             # Let's insert enough to be noticeable.
-            import random
-            batch_size = 100
             total_points = 10000
             
-            # Keep track of all data for recall calculation
-            all_vectors = [] # List of (id, vector)
+            # Keep track of all data for recall calculation, one id array and one vector array:
+            # slot 0 is ID 101, then the generated points, then ID 99999 inserted after load
+            ids_arr = np.empty(total_points + 2, dtype=np.int64)
+            vecs_arr = np.empty((total_points + 2, 5), dtype=np.float32)
             
             # Insert known points first for testing search later
             # Modified vector to be within [0, 1] range to avoid outlier issues during graph construction
             vec_101 = [0.5, 0.5, 0.5, 0.5, 0.5]
             execute_duck(cursor, f"INSERT INTO ltmdb_sql.vectordb.list VALUES (101, 'target', {vec_101})")
-            all_vectors.append((101, vec_101))
+            ids_arr[0] = 101
+            vecs_arr[0] = vec_101
             
-            for i in range(0, total_points, batch_size):
-                values = []
-                for j in range(batch_size):
-                    id = 1000 + i + j
-                    # Random vector of dim 5
-                    vec = [round(random.random(), 2) for _ in range(5)]
-                    all_vectors.append((id, vec))
-                    vec_str = "[" + ",".join(map(str, vec)) + "]"
-                    values.append(f"({id}, 'item_{id}', {vec_str})")
-                
-                sql = "INSERT INTO ltmdb_sql.vectordb.list VALUES " + ",".join(values)
-                # print(f"Inserting batch {i}...")
-                execute_duck(cursor, sql)
+            # Generate all random vectors of dim 5 up front, straight into their slots
+            ids_arr[1:total_points + 1] = np.arange(1000, 1000 + total_points)
+            data = vecs_arr[1:total_points + 1]
+            rng.random(dtype=np.float32, out=data)
+            np.round(data, 2, out=data)
+            
+            # Bulk load the points from one TSV file instead of sending ~100 INSERT statements.
+            # The server runs on 127.0.0.1, so DuckDB can read the file directly.
+            # Values are already rounded, so one fixed bytes template formats a whole row
+            row_tmpl = b"%d\titem_%d\t[%.2f,%.2f,%.2f,%.2f,%.2f]\n"
+            buf = bytearray()
+            for id, vec in zip(ids_arr[1:total_points + 1].tolist(), data.tolist()):
+                buf += row_tmpl % (id, id, *vec)
+            # mkstemp creates a fresh file (never following an existing path) with mode 0600;
+            # widen it to 0644 because the server process has to read it
+            fd, load_path = tempfile.mkstemp(prefix="test_diskann_data", suffix=".tsv")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    os.fchmod(f.fileno(), 0o644)
+                    f.write(buf)
+                execute_duck(cursor, f"COPY ltmdb_sql.vectordb.list FROM '{load_path}' (DELIMITER '\\t')")
+            finally:
+                os.remove(load_path)
+            conn.commit()
+
+            # execute_duck only prints errors, so make sure the bulk load actually landed
+            rows = execute_duck(cursor, "SELECT count(*) FROM ltmdb_sql.vectordb.list")
+            loaded = int(rows[0][0]) if rows else 0
+            if loaded != total_points + 1:
+                print(f"FAILURE: Expected {total_points + 1} rows after bulk load, found {loaded}.")
+                # The rest of the test would only run against the partial table
+                cleanup(conn, cursor)
+                return
             
             # 4. Create DiskANN Index with tiny RAM budget
             print("\n--- Creating DiskANN Index with 1MB budget ---")
@@ -124,18 +228,27 @@ def main():
             if rows:
                 print(f"Count of ID 101: {rows[0]}")
 
-            execute_duck(cursor, "CALL FAISS_ADD((SELECT id, vector FROM ltmdb_sql.vectordb.list), 'test_index')")
+            # Feed the index in id-range chunks rather than one full-table scan, so each call
+            # materializes fewer rows and the merges happen as the data streams in.
+            # Slots 0..total_points of ids_arr are sorted (101, then 1000 upwards).
+            add_chunk = 500
+            for start in range(0, total_points + 1, add_chunk):
+                lo = ids_arr[start]
+                hi = ids_arr[min(start + add_chunk, total_points + 1) - 1]
+                execute_duck(cursor, f"CALL FAISS_ADD((SELECT id, vector FROM ltmdb_sql.vectordb.list WHERE id BETWEEN {lo} AND {hi}), 'test_index')", verbose=False)
+            print(f"Added {total_points + 1} vectors in chunks of {add_chunk}")
             
             # 6. Describe Index
             print("\n--- Describing Index ---")
             rows = execute_duck(cursor, "SELECT faiss_describe('test_index')")
             if rows:
                 for row in rows:
-                    print(f"Result: {row}")
+                    row_str = str(row)
+                    print(f"Result: {row_str}")
                     # Check for version marker to confirm new code is running
-                    if "L2/IP_V2" in str(row):
+                    if "L2/IP_V2" in row_str:
                         print("SUCCESS: Code update confirmed (L2/IP_V2 found).")
-                    elif "L2/IP" in str(row):
+                    elif "L2/IP" in row_str:
                         print("WARNING: Old code detected! 'L2/IP' found instead of 'L2/IP_V2'. Please recompile and restart MySQL.")
 
             # 7. Search Index
@@ -150,16 +263,11 @@ def main():
                 print("Search Results:")
                 for row in rows:
                     print(row) # row format might be (json_string,) or actual columns depending on connector
-                    # Precise check for 101 in label/id
-                    # DuckDB result might be a tuple of values or a single string representation
-                    # We look for explicit 'label': 101 or similar structure, or parse the row
-                    row_str = str(row)
-                    if "'label': 101," in row_str or "'label': 101}" in row_str or " 101," in row_str or " 101)" in row_str:
-                         # Double check distance is small
-                         if "distance': 0.0" in row_str or "distance': 0}" in row_str or "distance': 1e-" in row_str:
-                             found_101 = True
-                         elif "'label': 101" in row_str: # Found label but distance might be non-zero due to float?
-                             found_101 = True
+                    if row_matches(row, 101):
+                        found_101 = True
+                        # Distance should be ~0, but a non-zero float distance still counts as found
+                        if not row_matches(row, 101, max_dist=1e-5):
+                            print("INFO: ID 101 found with non-zero distance.")
 
             if not found_101:
                 print("WARNING: ID 101 not found in search results! Deletion test will be invalid.")
@@ -168,22 +276,18 @@ def main():
                 
                 # 7.5 Test Save and Load
                 print("\n--- Testing Save and Load ---")
+                # Any previous save was already removed by the /tmp/test_diskann_save* cleanup above
                 save_path = "/tmp/test_diskann_save"
-                # Cleanup previous save if exists (optional, but good practice)
-                import shutil
-                import os
-                if os.path.exists(save_path + ".meta"):
-                    os.remove(save_path + ".meta")
                 
                 print(f"Saving index to {save_path}...")
                 execute_duck(cursor, f"CALL faiss_save('test_index', '{save_path}')")
                 
                 # Check if files were created
-                if os.path.exists(save_path + ".meta"):
-                    print(f"SUCCESS: Metadata file {save_path}.meta created.")
+                try:
                     with open(save_path + ".meta", 'r') as f:
+                        print(f"SUCCESS: Metadata file {save_path}.meta created.")
                         print(f"Metadata content: {f.read().strip()}")
-                else:
+                except FileNotFoundError:
                     print(f"FAILURE: Metadata file {save_path}.meta NOT created.")
 
                 if os.path.exists(save_path + "_disk.index"):
@@ -201,12 +305,7 @@ def main():
                 rows = execute_duck(cursor, search_sql)
                 found_101_loaded = False
                 if rows:
-                    row_str = str(rows)
-                    if "'label': 101," in row_str or "'label': 101}" in row_str or " 101," in row_str or " 101)" in row_str:
-                         if "distance': 0.0" in row_str or "distance': 0}" in row_str or "distance': 1e-" in row_str:
-                             found_101_loaded = True
-                         elif "'label': 101" in row_str:
-                             found_101_loaded = True
+                    found_101_loaded = any(row_matches(row, 101) for row in rows)
                 
                 if not found_101_loaded:
                     print("FAILURE: ID 101 not found after save/load!")
@@ -218,16 +317,14 @@ def main():
                 # Insert a new point
                 execute_duck(cursor, "INSERT INTO ltmdb_sql.vectordb.list VALUES (99999, 'target_new', [0.1, 0.1, 0.1, 0.1, 0.1])")
                 execute_duck(cursor, "CALL FAISS_ADD((SELECT id, vector FROM ltmdb_sql.vectordb.list WHERE id=99999), 'test_index')")
+                conn.commit()
                 
                 print("Verifying ID 99999 exists...")
                 search_sql_new = "SELECT faiss_search('test_index', 10, [0.1, 0.1, 0.1, 0.1, 0.1])"
                 rows = execute_duck(cursor, search_sql_new)
                 found_99999 = False
                 if rows:
-                    row_str = str(rows)
-                    # Check for 99999
-                    if "'label': 99999," in row_str or "'label': 99999}" in row_str or " 99999," in row_str or " 99999)" in row_str:
-                         found_99999 = True
+                    found_99999 = any(row_matches(row, 99999) for row in rows)
                 
                 if not found_99999:
                     print("FAILURE: ID 99999 not found after insertion on loaded index!")
@@ -237,6 +334,7 @@ def main():
                 # 8. Remove ID (DiskANN supported)
                 print("\n--- Removing ID 101 ---")
                 execute_duck(cursor, "CALL faiss_remove_ids('test_index', [101])")
+                conn.commit()
                 
                 # 9. Search Again (should not find 101)
                 print("\n--- Searching Index After Removal (Expect NO ID 101) ---")
@@ -246,8 +344,7 @@ def main():
                     print("Search Results:")
                     for row in rows:
                         print(row)
-                        row_str = str(row)
-                        if "'label': 101," in row_str or "'label': 101}" in row_str:
+                        if row_matches(row, 101):
                             found_101_after = True
                 
                 if found_101_after:
@@ -258,48 +355,102 @@ def main():
             # 9.5 Recall Test
             print("\n--- Testing Recall ---")
             
-            def l2_dist(v1, v2):
-                return sum((a - b) ** 2 for a, b in zip(v1, v2)) ** 0.5
+            # Add 99999 to the last slot for completeness
+            ids_arr[-1] = 99999
+            vecs_arr[-1] = 0.1
+
+            # Skip deleted ID 101 (slot 0); slicing keeps these views rather than copies
+            gt_ids_arr = ids_arr[1:]
+            gt_vecs_arr = vecs_arr[1:]
 
             def get_ground_truth(query, k):
-                # Simple linear scan
-                dists = []
-                for id, vec in all_vectors:
-                    # Skip deleted ID 101
-                    if id == 101: continue 
-                    # Note: 99999 was inserted but not added to all_vectors list in main loop
-                    # but we can ignore it for random recall test or add it
-                    
-                    d = l2_dist(query, vec)
-                    dists.append((d, id))
-                dists.sort(key=lambda x: x[0])
-                return [x[1] for x in dists[:k]]
-
-            # Add 99999 to all_vectors for completeness
-            all_vectors.append((99999, [0.1]*5))
-
-            num_queries = 100
-            k = 10
+                # Linear scan over all vectors at once; argpartition picks the top k in O(N), then only those k are sorted
+                diff = gt_vecs_arr - np.asarray(query, dtype=np.float32)
+                d2 = np.einsum('ij,ij->i', diff, diff)
+                idx = np.argpartition(d2, k)[:k]
+                return gt_ids_arr[idx[np.argsort(d2[idx])]].tolist()
+
             total_recall = 0
             print(f"Running {num_queries} random queries to calculate Average Recall@{k}...")
-            
-            for i in range(num_queries):
-                query = [round(random.random(), 2) for _ in range(5)]
-                gt_ids = set(get_ground_truth(query, k))
+
+            # The searches are independent, so fan them out over a pool of extra connections
+            # instead of paying one round-trip after another. Each worker checks out one
+            # connection for its whole slice of statements (a cursor can't be shared across
+            # threads), so checkout pings and returns happen once per worker, not per query.
+            search_workers = 8
+            search_pool = get_connection_pool(search_workers)
+
+            # Format every search statement once up front from a fixed template (queries are
+            # already rounded to 2 decimals), so the workers only execute
+            search_tmpl = f"SELECT faiss_search('test_index', {k}, [%.2f,%.2f,%.2f,%.2f,%.2f])"
+            search_sqls = [search_tmpl % tuple(query) for query in queries]
+
+            slice_size = -(-len(search_sqls) // search_workers)
+            search_slices = [search_sqls[i:i + slice_size] for i in range(0, len(search_sqls), slice_size)]
+
+            def run_searches(sqls):
+                search_conn = search_pool.get_connection()
+                try:
+                    # raw=True skips type conversion; these results are only pattern-matched
+                    search_cursor = search_conn.cursor(buffered=True, raw=True)
+                    # DiskANN search
+                    return [execute_duck(search_cursor, search_sql, verbose=False, expected_rows=k) for search_sql in sqls]
+                finally:
+                    # Hands the connection back to the pool
+                    search_conn.close()
+
+            try:
+                with ThreadPoolExecutor(max_workers=search_workers) as executor:
+                    # Slices are contiguous, so flattening keeps results in query order
+                    results = [rows for slice_rows in executor.map(run_searches, search_slices) for rows in slice_rows]
+            finally:
+                # MySQLConnectionPool has no public close; this disconnects every pooled connection
+                search_pool._remove_connections()
+
+            # Ground truth only depends on the corpus, the queries and k, so it is cached on disk
+            # and reruns skip the scan. (Scanning a sample of the corpus instead would bias recall:
+            # true neighbours outside the sample could never count as ground truth.)
+            # The cache is reused only while the corpus hash and the stored query set both match.
+            queries_path = os.path.join(GT_CACHE_DIR, "queries.npy")
+            gt_path = os.path.join(GT_CACHE_DIR, "gt.npy")
+            hash_path = os.path.join(GT_CACHE_DIR, "corpus.sha1")
+            digest = hashlib.sha1()
+            for arr in (gt_ids_arr, gt_vecs_arr, np.int64(k)):
+                digest.update(np.ascontiguousarray(arr).tobytes())
+            corpus_hash = digest.hexdigest()
+            gt = None
+            try:
+                with open(hash_path) as f:
+                    if f.read() == corpus_hash and np.array_equal(np.load(queries_path), queries):
+                        gt = np.load(gt_path)
+            except (OSError, ValueError):
+                pass
+            if gt is None:
+                gt = np.asarray([get_ground_truth(query, k) for query in queries], dtype=np.int64)
+                # The cache is only an optimization, so a failed save must not stop the test
+                try:
+                    os.makedirs(GT_CACHE_DIR, exist_ok=True)
+                    # Drop the old hash first so an interrupted save is never picked up as valid
+                    try:
+                        os.remove(hash_path)
+                    except FileNotFoundError:
+                        pass
+                    np.save(queries_path, queries)
+                    np.save(gt_path, gt)
+                    with open(hash_path, 'w') as f:
+                        f.write(corpus_hash)
+                except OSError as e:
+                    print(f"WARNING: Could not save ground truth cache to {GT_CACHE_DIR}: {e}")
+            else:
+                print(f"Loaded ground truth from {GT_CACHE_DIR}")
+
+            for gt_row, rows in zip(gt, results):
+                gt_ids = set(gt_row.tolist())
                 
-                # DiskANN search
-                search_sql = f"SELECT faiss_search('test_index', {k}, {query})"
-                rows = execute_duck(cursor, search_sql, verbose=False)
                 ann_ids = set()
                 if rows:
                     for row in rows:
-                        # Parse row string: "{'rank': 0, 'label': 5721, ...}"
-                        # This is a bit hacky parsing but works for simple test
-                        import re
-                        # Find all labels in the string representation
-                        labels = re.findall(r"'label': (\d+)", str(row))
-                        for label in labels:
-                            ann_ids.add(int(label))
+                        ann_ids.update(extract_labels(row))
                 
                 intersection = len(gt_ids.intersection(ann_ids))
                 recall = intersection / k
@@ -313,10 +464,7 @@ def main():
                 print("SUCCESS: Recall is acceptable.")
 
             # 10. Cleanup
-            print("\n--- Cleanup ---")
-            execute_duck(cursor, "CALL faiss_destroy('test_index')")
-            execute_duck(cursor, "drop table ltmdb_sql.vectordb.list")
-            execute_duck(cursor, "drop schema ltmdb_sql.vectordb")
+            cleanup(conn, cursor)
             
             print("\nTest Finished Successfully")
 